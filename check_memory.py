@@ -1,28 +1,43 @@
+from itertools import chain
+
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from diffusion.model.builder import get_vae, get_tokenizer_and_text_encoder
+from accelerate import init_empty_weights
+from diffusers import AutoencoderDC
+from transformers import AutoConfig, AutoModelForCausalLM
 
 def get_model_size(model):
-    param_size = 0
-    for param in model.parameters():
-        param_size += param.nelement() * param.element_size()
-    buffer_size = 0
-    for buffer in model.buffers():
-        buffer_size += buffer.nelement() * buffer.element_size()
-    return (param_size + buffer_size) / 1024**2  # Convert to MB
+    # Sum storage bytes once per underlying storage, so tensors sharing memory are not double-counted
+    seen_storages = set()
+    size = 0
+    for tensor in chain(model.parameters(), model.buffers()):
+        if tensor.is_meta:
+            # Meta tensors have no address to deduplicate on, only shape and dtype
+            size += tensor.nelement() * tensor.element_size()
+            continue
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() in seen_storages:
+            continue
+        seen_storages.add(storage.data_ptr())
+        size += storage.nbytes()
+    return size / 1024**2  # Convert to MB
 
 def main():
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    
+    # Build the models from their configs on the meta device: parameters carry shape and dtype
+    # but no storage, so no weights are downloaded and nothing is allocated on the GPU.
+
     # Load VAE
-    print("Loading VAE...")
-    vae = get_vae("AutoencoderDC", "mit-han-lab/dc-ae-f32c32-sana-1.1-diffusers", device)
+    print("Loading VAE config...")
+    with init_empty_weights():
+        vae = AutoencoderDC.from_config(AutoencoderDC.load_config("mit-han-lab/dc-ae-f32c32-sana-1.1-diffusers"))
     vae_size = get_model_size(vae)
     print(f"VAE size: {vae_size:.2f} MB")
     
-    # Load Text Encoder
-    print("\nLoading Text Encoder...")
-    tokenizer, text_encoder = get_tokenizer_and_text_encoder("gemma-2-2b-it", device)
+    # Load Text Encoder (same dtype and decoder-only module as get_tokenizer_and_text_encoder)
+    print("\nLoading Text Encoder config...")
+    with init_empty_weights():
+        text_encoder = AutoModelForCausalLM.from_config(
+            AutoConfig.from_pretrained("google/gemma-2-2b-it"), torch_dtype=torch.bfloat16
+        ).get_decoder()
     text_encoder_size = get_model_size(text_encoder)
     print(f"Text Encoder size: {text_encoder_size:.2f} MB")
     
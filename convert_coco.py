@@ -1,153 +1,822 @@
-`# Modified again to include height, width, and use 'prompt' key in JSON
+# Modified again to include height, width, and use 'prompt' key in JSON
 import os
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import webdataset as wds
 import io
+import struct
+import cv2
+import numpy as np
 from PIL import Image, UnidentifiedImageError
 from tqdm import tqdm
 import json
 import argparse
-import glob
-from collections import defaultdict
+import copy
+import gzip
+import multiprocessing
+import logging
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import tarfile
+import time
+from array import array
 
-def get_image_bytes_validate_and_dims(img_bytes, filename_for_error):
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PARQUET_BATCH_SIZE = 2048 # Rows per streamed record batch; bounds memory to one batch of image bytes
+SHARD_INDEX_STRIDE = 10000 # Shard index range reserved for each worker process
+TARGET_SHARD_BYTES = 512 * 1024 * 1024 # Shards are cut at this size; 256 MB-4 GB shards stream well from local disk and object stores
+JPEG_QUALITY = 95 # Quality used when a JPEG has to be re-encoded
+SHARD_WRITE_BUFFER_SIZE = 4 * 1024 * 1024 # Write buffer for shard files; the io default of 8 KiB means a syscall per few KB written
+GZIP_COMPRESS_LEVEL = 1 # For --compress; compression happens once, so favor writer speed over ratio
+VALIDATE_THREADS = 4 # Threads per worker process for images that must be decoded (re-encodes, PIL fallback, --strict)
+MAX_PENDING_SAMPLES = 64 # Samples read but not yet written (mostly waiting on the thread pool), per worker process
+
+def dumps_json(obj):
+    """
+    Serializes sample metadata to UTF-8 JSON bytes, so the webdataset encoder passes it through untouched.
+    Uses orjson when installed; the json fallback produces the same compact output.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+logger = logging.getLogger(__name__)
+
+_OK_FORMATS = frozenset(('jpeg', 'png', 'webp')) # Formats kept as-is; anything else is saved as jpeg
+
+# Start-of-frame markers (baseline, progressive, lossless, arithmetic); 0xC4, 0xC8 and 0xCC are not frames
+_JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+
+def fast_jpeg_dims(img_bytes):
+    """
+    Reads JPEG dimensions from the SOF segment header without decoding any pixels.
+
+    Returns:
+        tuple: (width, height, num_components) or None if img_bytes is not a parseable JPEG.
+    """
+    if img_bytes[:3] != b"\xff\xd8\xff":
+        return None
+
+    pos = 2
+    end = len(img_bytes)
+    while pos + 4 <= end:
+        if img_bytes[pos] != 0xFF:
+            return None
+        marker = img_bytes[pos + 1]
+        if marker == 0xFF: # Fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8: # Standalone markers carry no length
+            pos += 2
+            continue
+        if marker == 0xDA: # Start of scan reached without a frame header
+            return None
+
+        (segment_length,) = struct.unpack_from(">H", img_bytes, pos + 2)
+        if marker in _JPEG_SOF_MARKERS:
+            if pos + 10 > end:
+                return None
+            height, width, num_components = struct.unpack_from(">HHB", img_bytes, pos + 5)
+            if width == 0 or height == 0:
+                return None
+            return width, height, num_components
+        pos += 2 + segment_length
+
+    return None
+
+# PNG color type -> number of channels (gray, RGB, palette, gray+alpha, RGBA)
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def sniff_dims(img_bytes):
+    """
+    Reads format and dimensions of a JPEG, PNG or WebP image from its header bytes, without PIL.
+
+    Returns:
+        tuple: (img_format, width, height, num_channels) or None if the header is not recognized.
+    """
+    if img_bytes[:3] == b"\xff\xd8\xff":
+        jpeg_header = fast_jpeg_dims(img_bytes)
+        if jpeg_header is None:
+            return None
+        width, height, num_components = jpeg_header
+        return 'jpeg', width, height, num_components
+
+    if img_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        # The IHDR chunk must come first: length(4) type(4) width(4) height(4) bit_depth(1) color_type(1)
+        if len(img_bytes) < 26 or img_bytes[12:16] != b"IHDR":
+            return None
+        width, height, _, color_type = struct.unpack_from(">IIBB", img_bytes, 16)
+        if width == 0 or height == 0 or color_type not in _PNG_CHANNELS:
+            return None
+        return 'png', width, height, _PNG_CHANNELS[color_type]
+
+    if img_bytes[:4] == b"RIFF" and img_bytes[8:12] == b"WEBP" and len(img_bytes) >= 30:
+        chunk = img_bytes[12:16]
+        if chunk == b"VP8 " and img_bytes[23:26] == b"\x9d\x01\x2a": # Lossy: 14-bit sizes after the start code
+            width, height = struct.unpack_from("<HH", img_bytes, 26)
+            return 'webp', width & 0x3FFF, height & 0x3FFF, 3
+        if chunk == b"VP8L" and img_bytes[20] == 0x2F: # Lossless: 14-bit (size - 1) fields and an alpha hint
+            (bits,) = struct.unpack_from("<I", img_bytes, 21)
+            return 'webp', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 4 if (bits >> 28) & 1 else 3
+        if chunk == b"VP8X": # Extended: flags byte, then 24-bit (canvas size - 1) fields
+            flags = img_bytes[20]
+            width = int.from_bytes(img_bytes[24:27], "little") + 1
+            height = int.from_bytes(img_bytes[27:30], "little") + 1
+            return 'webp', width, height, 4 if flags & 0x10 else 3
+
+    return None
+
+def needs_reencode(img_format, num_channels):
+    """Whether a sniffed image must be decoded and re-encoded: only JPEGs without 3 components are."""
+    return img_format == 'jpeg' and num_channels != 3
+
+def reencode_jpeg_as_rgb(img_bytes):
+    """
+    Decodes a (grayscale/CMYK) JPEG with OpenCV's libjpeg-turbo and re-encodes it as 3-channel JPEG.
+
+    Returns:
+        tuple: (jpeg_bytes, width, height) or None if OpenCV cannot handle the image.
+    """
+    arr = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if arr is None:
+        return None
+    ok, buffer = cv2.imencode(".jpg", arr, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        return None
+    return buffer.tobytes(), arr.shape[1], arr.shape[0]
+
+def get_image_bytes_validate_and_dims(img_bytes, filename_for_error, strict=False):
     """
     Tries to open image bytes with PIL to validate, get format, and dimensions.
+    JPEG, PNG and WebP take a fast path: format and dimensions come from the header bytes
+    and only non-RGB JPEGs are decoded. PIL is used only when the header cannot be parsed.
+    With strict=True every image is additionally checked with PIL: verify() on the fast path,
+    a full load() of the single opened image on the PIL path.
 
     Returns:
         tuple: (validated_bytes, img_format, width, height) or (None, None, None, None) on error.
     """
     try:
-        img = Image.open(io.BytesIO(img_bytes))
-        img.verify() # Verify core image data integrity
-
-        # Reopen after verify to access properties
-        img = Image.open(io.BytesIO(img_bytes))
-        width, height = img.size
-        img_format = img.format.lower() if img.format else 'jpeg' # Default to jpeg if format is missing
-
-        if img_format not in ['jpeg', 'png', 'webp']: # Added webp as common format
-             print(f"Warning: Unexpected image format '{img_format}' for {filename_for_error}. Attempting to save as jpeg.")
-             img_format = 'jpeg' # Default to saving as jpeg
-
-        # Ensure image is RGB for JPEG saving, handle PNG transparency if needed
-        if img_format == 'jpeg' and img.mode != 'RGB':
-            print(f"Converting {filename_for_error} from {img.mode} to RGB for JPEG.")
-            img = img.convert('RGB')
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG')
-            validated_bytes = buffer.getvalue()
-        elif img_format == 'png' and img.mode == 'RGBA':
-             # Decide how to handle transparency - convert to RGB or keep RGBA
-             # Converting to RGB is safer if VAE expects 3 channels
-             # print(f"Converting RGBA PNG {filename_for_error} to RGB.")
-             # img = img.convert('RGB')
-             # buffer = io.BytesIO()
-             # img.save(buffer, format='PNG')
-             # validated_bytes = buffer.getvalue()
-             validated_bytes = img_bytes # Keep original RGBA bytes for now
-        else:
-            validated_bytes = img_bytes # Keep original bytes if already suitable
+        sniffed = sniff_dims(img_bytes)
+        if strict and sniffed is not None:
+            with Image.open(io.BytesIO(img_bytes)) as img:
+                img.verify() # Verify core image data integrity
+
+        if sniffed is not None:
+            img_format, width, height, num_channels = sniffed
+            if not needs_reencode(img_format, num_channels):
+                return img_bytes, img_format, width, height
+
+            # Grayscale (1) or CMYK/YCCK (4) components, convert for 3-channel JPEG
+            logger.info("Converting %s from %d components to RGB for JPEG.", filename_for_error, num_channels)
+            reencoded = reencode_jpeg_as_rgb(img_bytes)
+            if reencoded is not None:
+                validated_bytes, width, height = reencoded
+                return validated_bytes, 'jpeg', width, height
+            # Otherwise fall back to PIL below
+
+        # Single open for the PIL path: format, size, conversion and re-encode all use this image
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            if strict and sniffed is None:
+                # Decoding checks the data like verify() would, but keeps the image usable without reopening
+                img.load()
+            width, height = img.size
+            img_format = (img.format or 'JPEG').lower() # Default to jpeg if format is missing
+
+            if img_format not in _OK_FORMATS:
+                 logger.warning("Unexpected image format '%s' for %s. Attempting to save as jpeg.", img_format, filename_for_error)
+                 img_format = 'jpeg' # Default to saving as jpeg
+
+            # Ensure image is RGB for JPEG saving, handle PNG transparency if needed
+            if img_format == 'jpeg' and img.mode != 'RGB':
+                logger.info("Converting %s from %s to RGB for JPEG.", filename_for_error, img.mode)
+                buffer = io.BytesIO()
+                img.convert('RGB').save(buffer, format='JPEG', quality=JPEG_QUALITY)
+                validated_bytes = buffer.getvalue()
+            elif img_format == 'png' and img.mode == 'RGBA':
+                 # Decide how to handle transparency - convert to RGB or keep RGBA
+                 # Converting to RGB is safer if VAE expects 3 channels
+                 # print(f"Converting RGBA PNG {filename_for_error} to RGB.")
+                 # img = img.convert('RGB')
+                 # buffer = io.BytesIO()
+                 # img.save(buffer, format='PNG')
+                 # validated_bytes = buffer.getvalue()
+                 validated_bytes = img_bytes # Keep original RGBA bytes for now
+            else:
+                validated_bytes = img_bytes # Keep original bytes if already suitable
 
         return validated_bytes, img_format, width, height
     except UnidentifiedImageError:
-        print(f"Error: Cannot identify image file {filename_for_error}. Skipping.")
+        logger.warning("Cannot identify image file %s. Skipping.", filename_for_error)
         return None, None, None, None
     except Exception as e:
-        print(f"Error validating/processing image {filename_for_error}: {e}")
+        logger.warning("Error validating/processing image %s: %s", filename_for_error, e)
         return None, None, None, None
 
-def convert_parquet_to_webdataset_with_dims(parquet_files, output_dir, output_prefix, samples_per_shard=10000):
+class LongestCaptions:
+    """
+    Longest caption per filename, stored column-wise under dense integer ids.
+
+    Instead of a dict (or tuple) per filename, each filename maps to an index into flat
+    caption / caption-length / first-file arrays, which keeps per-entry overhead low for
+    hundreds of thousands of images.
+    """
+
+    def __init__(self):
+        self.index_of = {}
+        self.captions = []
+        self.caption_lengths = array('i')
+        self.first_file_indices = array('i')
+
+    def __len__(self):
+        return len(self.captions)
+
+    def _append(self, filename, caption, caption_length, first_file_index):
+        self.index_of[filename] = len(self.captions)
+        self.captions.append(caption)
+        self.caption_lengths.append(caption_length)
+        self.first_file_indices.append(first_file_index)
+
+    def add(self, filename, caption, file_index, caption_length=None):
+        """Records a caption; rows must be added in file order so the first caption wins on ties."""
+        if caption_length is None:
+            caption_length = len(caption)
+        i = self.index_of.get(filename)
+        if i is None:
+            self._append(filename, caption, caption_length, file_index)
+        elif caption_length > self.caption_lengths[i]:
+            self.captions[i] = caption
+            self.caption_lengths[i] = caption_length
+
+    def add_distinct(self, filenames, captions, caption_lengths, file_index):
+        """Like add() for each entry, for filenames that are distinct within the call; new filenames are appended in bulk."""
+        new_rows = []
+        next_index = len(self.captions)
+        for row, filename in enumerate(filenames):
+            i = self.index_of.get(filename)
+            if i is None:
+                self.index_of[filename] = next_index
+                next_index += 1
+                new_rows.append(row)
+            elif caption_lengths[row] > self.caption_lengths[i]:
+                self.captions[i] = captions[row]
+                self.caption_lengths[i] = caption_lengths[row]
+        if len(new_rows) < len(filenames):
+            captions = [captions[row] for row in new_rows]
+            caption_lengths = [caption_lengths[row] for row in new_rows]
+        self.captions.extend(captions)
+        self.caption_lengths.extend(caption_lengths)
+        self.first_file_indices.extend(array('i', [file_index]) * len(new_rows))
+
+    def merge(self, other):
+        """Merges in the result for a later range of files."""
+        for filename, j in other.index_of.items():
+            i = self.index_of.get(filename)
+            if i is None:
+                self._append(filename, other.captions[j], other.caption_lengths[j], other.first_file_indices[j])
+            elif other.caption_lengths[j] > self.caption_lengths[i]:
+                self.captions[i] = other.captions[j]
+                self.caption_lengths[i] = other.caption_lengths[j]
+
+    def get(self, filename):
+        """
+        Returns:
+            tuple: (first_file_index, longest_caption) or None if the filename has no caption.
+        """
+        i = self.index_of.get(filename)
+        if i is None:
+            return None
+        return self.first_file_indices[i], self.captions[i]
+
+def has_dictionary_pages(metadata, column_name):
+    """Whether the column is dictionary-encoded in the first row group of the Parquet file."""
+    if metadata.num_row_groups == 0:
+        return False
+    row_group = metadata.row_group(0)
+    for j in range(row_group.num_columns):
+        column = row_group.column(j)
+        if column.path_in_schema == column_name:
+            return any(encoding in ("PLAIN_DICTIONARY", "RLE_DICTIONARY") for encoding in column.encodings)
+    return False
+
+def add_dictionary_captions(longest, filenames, captions, file_index):
+    """
+    Adds a dictionary-encoded caption column to longest, reducing it to one caption per filename with vector ops.
+
+    Caption lengths are computed once per dictionary value and gathered per row through the indices. A lexsort
+    by (filename, -length, row) puts each filename's longest caption (earliest row on ties) first in its group,
+    so only those winning dictionary values are turned into Python strings.
+    """
+    rows = np.arange(len(captions))
+    if captions.null_count:
+        rows = rows[captions.is_valid().to_numpy(zero_copy_only=False)]
+    if len(rows) == 0:
+        return
+
+    filename_ids = pc.dictionary_encode(filenames, null_encoding="encode").indices.to_numpy(zero_copy_only=False)[rows]
+    caption_ids = captions.indices.fill_null(0).to_numpy(zero_copy_only=False)[rows]
+    caption_lengths = pc.utf8_length(captions.dictionary).to_numpy(zero_copy_only=False)[caption_ids]
+
+    order = np.lexsort((rows, -caption_lengths, filename_ids))
+    sorted_ids = filename_ids[order]
+    is_first = np.empty(len(order), dtype=bool)
+    is_first[0] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=is_first[1:])
+    winners = np.sort(order[is_first]) # Back in row order
+
+    longest.add_distinct(
+        filenames.take(pa.array(rows[winners])).to_pylist(),
+        captions.dictionary.take(pa.array(caption_ids[winners])).to_pylist(),
+        caption_lengths[winners].tolist(),
+        file_index,
+    )
+
+def find_longest_captions(parquet_files, file_offset=0):
+    """
+    Scans only the 'filename' and 'caption' columns of the Parquet files.
+    Dictionary-encoded caption columns are read as Arrow dictionaries, one row group at a time,
+    so repeated captions are measured once per row group and only each filename's longest one is decoded.
+
+    Args:
+        parquet_files (list): List of paths to input Parquet files.
+        file_offset (int): Index of parquet_files[0] in the full, sorted file list.
+
+    Returns:
+        LongestCaptions: Longest caption and first file index for each filename.
+    """
+    longest = LongestCaptions()
+
+    for file_index, pf_path in enumerate(tqdm(parquet_files, desc="Scanning Captions"), start=file_offset):
+        try:
+            metadata = pq.read_metadata(pf_path)
+            if has_dictionary_pages(metadata, "caption"):
+                # Whole row groups, since each batch would otherwise carry (and re-measure) the full row group dictionary
+                pf = pq.ParquetFile(pf_path, metadata=metadata, read_dictionary=["caption"])
+                for row_group in range(pf.num_row_groups):
+                    table = pf.read_row_group(row_group, columns=["filename", "caption"])
+                    for batch in table.to_batches():
+                        add_dictionary_captions(longest, batch.column("filename"), batch.column("caption"), file_index)
+                continue
+
+            pf = pq.ParquetFile(pf_path, metadata=metadata)
+            for batch in pf.iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=["filename", "caption"]):
+                filenames = batch.column("filename").to_pylist()
+                captions = batch.column("caption").to_pylist()
+
+                for filename, caption in zip(filenames, captions):
+                    if caption is not None:
+                        longest.add(filename, caption, file_index)
+        except Exception as e:
+            logger.warning("Error reading or processing Parquet file %s: %s", pf_path, e)
+            continue
+
+    return longest
+
+def merge_longest_captions(partial_results):
+    """
+    Reduces per-worker results of find_longest_captions, given in file order, into a single LongestCaptions.
+    """
+    merged = LongestCaptions()
+    for partial in partial_results:
+        merged.merge(partial)
+    return merged
+
+def first_occurrence_rows(column, valid=None):
+    """
+    Returns:
+        list: Indices of the first row holding each distinct value of column, in row order.
+        With a valid mask, a value's first valid row is picked over earlier invalid ones.
+    """
+    value_ids = pc.index_in(column, value_set=pc.unique(column)).to_numpy(zero_copy_only=False)
+    if valid is None:
+        _, first_rows = np.unique(value_ids, return_index=True)
+    else:
+        # Sorted by value, then valid rows first, then row order: each value's group starts with its pick
+        order = np.lexsort((np.arange(len(value_ids)), ~valid, value_ids))
+        sorted_ids = value_ids[order]
+        is_first = np.empty(len(order), dtype=bool)
+        is_first[:1] = True
+        np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=is_first[1:])
+        first_rows = order[is_first]
+    first_rows.sort()
+    return first_rows.tolist()
+
+def image_bytes_array(image_column):
+    """
+    Returns:
+        pyarrow.Array: The image bytes of image_column, which is either the column itself or the 'bytes' field
+        of a struct column ({'bytes': ..., 'path': ...}); None for a struct column without a 'bytes' field.
+    """
+    if not pa.types.is_struct(image_column.type):
+        return image_column
+    field_index = image_column.type.get_field_index("bytes")
+    # flatten() (unlike field()) accounts for the struct's own offset and nulls
+    return image_column.flatten()[field_index] if field_index >= 0 else None
+
+def iter_image_bytes(image_column, rows=None):
+    """
+    Yields the image bytes of each row as a zero-copy memoryview into the Arrow data buffer, or None for nulls.
+
+    image_column is either a binary column or a struct column with a 'bytes' field ({'bytes': ..., 'path': ...}).
+    Other layouts fall back to to_pylist(), which copies every value into a Python object.
+    rows optionally restricts (and orders) the rows yielded; by default every row is.
+    """
+    binary = image_bytes_array(image_column)
+    if binary is None or not (pa.types.is_binary(binary.type) or pa.types.is_large_binary(binary.type)):
+        image_fields = image_column.to_pylist()
+        for image_field in image_fields if rows is None else (image_fields[i] for i in rows):
+            if isinstance(image_field, dict):
+                yield image_field.get('bytes')
+            elif isinstance(image_field, bytes):
+                yield image_field
+            else:
+                yield None
+        return
+
+    _, offsets_buffer, data_buffer = binary.buffers()
+    offset_dtype = np.int64 if pa.types.is_large_binary(binary.type) else np.int32
+    offsets = np.frombuffer(offsets_buffer, dtype=offset_dtype)[binary.offset:binary.offset + len(binary) + 1].tolist()
+    # Arrow exports buffers as signed chars; cast so slices compare and index like bytes
+    data = memoryview(data_buffer).cast("B") if data_buffer is not None else memoryview(b"")
+    valid = binary.is_valid().to_numpy(zero_copy_only=False) if binary.null_count else None
+
+    for i in range(len(binary)) if rows is None else rows:
+        if valid is not None and not valid[i]:
+            yield None
+        else:
+            yield data[offsets[i]:offsets[i + 1]]
+
+class TemplateTarWriter(wds.TarWriter):
+    """
+    TarWriter that emits member headers from a cached template instead of a TarInfo per member.
+
+    Every member of a shard shares mode, owner, mtime and type, so only the name, size and checksum fields
+    of the 512-byte header change. These are patched into a copy of the template, with the checksum updated
+    incrementally from the template's. Members whose name or size do not fit the plain header fields
+    go through tarfile as usual.
+    """
+
+    def __init__(self, fileobj, **kw):
+        super().__init__(fileobj, **kw)
+        template = tarfile.TarInfo("")
+        # An integer mtime fits the plain header; a float one (as TarWriter uses) costs an extra pax header per member
+        template.mtime = int(self.mtime if self.mtime is not None else time.time())
+        template.mode = self.mode
+        template.uname = self.user
+        template.gname = self.group
+        self.header_template = template
+        header = bytearray(template.tobuf(self.tarstream.format, self.tarstream.encoding, self.tarstream.errors))
+        if len(header) != tarfile.BLOCKSIZE:
+            raise ValueError("tar header template must fit in a single block")
+        header[148:156] = b" " * 8 # The checksum is computed with its own field set to spaces
+        self.header = header
+        self.header_checksum = sum(header) - sum(header[124:136]) # Excludes the size field, patched per member
+
+    def write(self, obj):
+        total = 0
+        obj = self.encoder(obj)
+        if "__key__" not in obj:
+            raise ValueError("object must contain a __key__")
+        key = obj["__key__"]
+        tarstream = self.tarstream
+        for k in sorted(obj.keys()):
+            if k == "__key__" or (not self.keep_meta and k[0] == "_"):
+                continue
+            v = obj[k]
+            if isinstance(v, str):
+                v = v.encode("utf-8")
+            if not isinstance(v, (bytes, bytearray, memoryview)):
+                raise ValueError(f"{k} doesn't map to a bytes after encoding ({type(v)})")
+
+            name = f"{key}.{k}"
+            size = len(v)
+            if len(name) > 100 or not name.isascii() or size >= 8**11: # Would need a pax/GNU header
+                ti = copy.copy(self.header_template)
+                ti.name = name
+                ti.size = size
+                tarstream.addfile(ti, io.BytesIO(v))
+                total += size
+                continue
+
+            name_field = name.encode("ascii")
+            size_field = b"%011o\0" % size
+            header = self.header.copy()
+            header[0:len(name_field)] = name_field
+            header[124:136] = size_field
+            header[148:155] = b"%06o\0" % (self.header_checksum + sum(name_field) + sum(size_field))
+
+            padding = -size % tarfile.BLOCKSIZE
+            tarstream.fileobj.write(header)
+            tarstream.fileobj.write(v)
+            if padding:
+                tarstream.fileobj.write(tarfile.NUL * padding)
+            tarstream.offset += tarfile.BLOCKSIZE + size + padding
+            total += size
+
+        return total
+
+class TemplateShardWriter(wds.ShardWriter):
+    """
+    ShardWriter that writes each shard with TemplateTarWriter.
+    """
+
+    def next_stream(self):
+        self.finish()
+        self.fname = self.pattern % self.shard
+        if self.verbose:
+            print("# writing", self.fname, self.count, "%.1f GB" % (self.size / 1e9), self.total)
+        self.shard += 1
+        self.tarstream = TemplateTarWriter(self.opener(self.fname) if self.opener else self.fname, **self.kw)
+        self.count = 0
+        self.size = 0
+
+def make_buffered_shard_opener(buffer_size=SHARD_WRITE_BUFFER_SIZE, compresslevel=None):
+    """
+    Builds (opener, post) callbacks for wds.ShardWriter that open each shard with a large write buffer.
+    If compresslevel is given, the shard is gzip-compressed on the way to the file.
+
+    TarWriter does not close file objects it did not open itself, so post closes (and flushes) the file
+    once ShardWriter has finished the shard.
+    """
+    open_files = {}
+
+    def opener(fname):
+        f = open(fname, "wb", buffering=buffer_size)
+        open_files[fname] = [f]
+        if compresslevel is not None:
+            f = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=compresslevel)
+            open_files[fname].append(f)
+        return f
+
+    def post(fname):
+        files = open_files.pop(fname, None)
+        if files is not None:
+            for f in reversed(files): # Gzip trailer first, then the file itself
+                f.close()
+            logger.info("Finished shard %s: %.1f MiB", fname, os.path.getsize(fname) / 1024**2)
+
+    return opener, post
+
+def iter_parquet_batches(pf_path, columns):
+    """
+    Yields record batches of the given columns of a Parquet file.
+    A file that cannot be opened or read is reported and ends early; errors raised by the caller are not caught.
+    """
+    try:
+        pf = pq.ParquetFile(pf_path)
+        yield from pf.iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=columns)
+    except Exception as e:
+        logger.warning("Error reading Parquet file %s: %s", pf_path, e)
+
+def build_sample(base_filename, image_bytes, prompt_text, strict=False):
+    """
+    Validates an image and builds its WebDataset sample.
+
+    Returns:
+        dict: The sample ready for ShardWriter.write, or None if the image is invalid.
+    """
+    # Validate image, get format and dimensions
+    validated_bytes, img_format, width, height = get_image_bytes_validate_and_dims(image_bytes, base_filename, strict)
+
+    if validated_bytes is None:
+        return None # Skip if image is invalid
+    return make_sample(base_filename, img_format, validated_bytes, prompt_text, width, height)
+
+def make_sample(base_filename, img_format, validated_bytes, prompt_text, width, height):
+    """
+    Returns:
+        dict: The WebDataset sample for an already validated image.
+    """
+    if isinstance(validated_bytes, memoryview):
+        validated_bytes = validated_bytes.tobytes() # The wds encoder only passes bytes through as-is
+
+    # Create the final sample dictionary for WebDataset
+    return {
+        "__key__": os.path.splitext(base_filename)[0], # Base filename as key
+        img_format: validated_bytes,                   # Image bytes with format extension as key
+        "json": dumps_json({                           # JSON metadata, pre-encoded to bytes
+            "prompt": prompt_text,                     # The selected prompt text
+            "width": width,                            # Image width
+            "height": height                           # Image height
+            # Optional: add cocoid back if needed: "cocoid": data.get("cocoid", None)
+        })
+    }
+
+def write_webdataset_shards(
+    parquet_files,
+    shard_pattern,
+    longest_captions,
+    samples_per_shard,
+    target_shard_bytes=TARGET_SHARD_BYTES,
+    start_shard=0,
+    file_offset=0,
+    strict=False,
+    num_threads=VALIDATE_THREADS,
+):
+    """
+    Streams images from the Parquet files and writes them to WebDataset TAR shards.
+
+    A filename is only written from the first file it appears in (see find_longest_captions),
+    so workers handling disjoint file ranges never emit the same sample twice.
+
+    Images whose header gives format and size (RGB JPEG, PNG, WebP) are turned into samples on this thread:
+    header parsing is pure Python and holds the GIL, so a thread pool only adds handoff cost there.
+    Images that must be decoded (non-RGB JPEGs, unparseable headers, strict=True) go to a thread pool,
+    where decode/encode releases the GIL. Samples are written in read order either way, and at most
+    MAX_PENDING_SAMPLES are waiting to be written to bound memory.
+
+    Returns:
+        int: Number of samples written.
+    """
+    total_images_processed = 0
+    written = set() # Filenames already emitted; the first image seen for a filename is kept
+    pending = deque() # Samples (or None) and futures of build_sample, oldest first
+    skipped = Counter() # Skip reasons since the last finished shard, reported once per shard
+
+    def write_finished(max_pending):
+        nonlocal total_images_processed
+        # Everything ready at the head goes out at once; beyond max_pending, wait for the oldest future
+        while pending and (len(pending) > max_pending or not isinstance(pending[0], Future) or pending[0].done()):
+            sample = pending.popleft()
+            if isinstance(sample, Future):
+                sample = sample.result()
+            if sample is None:
+                skipped["invalid image"] += 1
+            else:
+                sink.write(sample)
+                total_images_processed += 1
+
+    def report_skipped(fname):
+        if skipped:
+            logger.warning("%s: skipped %d images (%s)", fname, sum(skipped.values()), ", ".join(f"{k}: {v}" for k, v in skipped.items()))
+            skipped.clear()
+
+    opener, close_shard = make_buffered_shard_opener(compresslevel=GZIP_COMPRESS_LEVEL if shard_pattern.endswith(".gz") else None)
+
+    def post(fname):
+        close_shard(fname)
+        report_skipped(fname)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor, TemplateShardWriter(
+        shard_pattern, maxcount=samples_per_shard, maxsize=target_shard_bytes, start_shard=start_shard, opener=opener, post=post
+    ) as sink:
+        for file_index, pf_path in enumerate(tqdm(parquet_files, desc="Writing Shards"), start=file_offset):
+            missing = {} # Filenames skipped for missing bytes or prompt in this file, in read order
+            # Read errors end this file early; write errors propagate instead of silently dropping samples
+            for batch in iter_parquet_batches(pf_path, ["filename", "image"]):
+                # Repeated rows of a filename (one per caption) carry the same image, so only the first row
+                # of each filename in the batch that has image bytes is looked at; duplicates never reach Python
+                filename_column = batch.column("filename")
+                image_column = batch.column("image")
+                image_bytes_column = image_bytes_array(image_column)
+                has_bytes = None
+                if image_bytes_column is not None and image_bytes_column.null_count:
+                    has_bytes = image_bytes_column.is_valid().to_numpy(zero_copy_only=False)
+                rows = first_occurrence_rows(filename_column, has_bytes)
+                filenames = filename_column.take(pa.array(rows, pa.int64())).to_pylist()
+
+                # Image bytes stay in the Arrow buffer; only samples that get written are copied out
+                for base_filename, image_bytes in zip(filenames, iter_image_bytes(image_column, rows)):
+                    if base_filename in written:
+                        continue
+
+                    first_file_index, prompt_text = longest_captions.get(base_filename) or (file_index, None) # Longest prompt text found
+                    if first_file_index != file_index:
+                        continue # Owned by an earlier file
+
+                    if image_bytes is None or not prompt_text:
+                        missing[base_filename] = None
+                        continue
+
+                    written.add(base_filename)
+                    sniffed = None if strict else sniff_dims(image_bytes)
+                    if sniffed is not None and not needs_reencode(sniffed[0], sniffed[3]):
+                        img_format, width, height, _ = sniffed
+                        pending.append(make_sample(base_filename, img_format, image_bytes, prompt_text, width, height))
+                    else:
+                        pending.append(executor.submit(build_sample, base_filename, image_bytes, prompt_text, strict))
+                    write_finished(MAX_PENDING_SAMPLES)
+
+            # A filename's rows can span batches, so a skip is only final once its owning file is done
+            for base_filename in missing:
+                if base_filename not in written:
+                    logger.warning("Missing image bytes or prompt for %s. Skipping.", base_filename)
+                    skipped["missing image or prompt"] += 1
+
+        write_finished(0)
+
+    report_skipped(shard_pattern % start_shard) # Only left over if no shard was ever opened
+    return total_images_processed
+
+# Set once per pool worker by the initializer so the caption map is not re-pickled for every task
+_worker_longest_captions = None
+
+def _init_write_worker(longest_captions):
+    global _worker_longest_captions
+    _worker_longest_captions = longest_captions
+
+def _find_longest_captions_task(task):
+    parquet_files, file_offset = task
+    return find_longest_captions(parquet_files, file_offset)
+
+def _write_webdataset_shards_task(task):
+    parquet_files, shard_pattern, samples_per_shard, target_shard_bytes, start_shard, file_offset, strict, num_threads = task
+    return write_webdataset_shards(
+        parquet_files,
+        shard_pattern,
+        _worker_longest_captions,
+        samples_per_shard,
+        target_shard_bytes,
+        start_shard,
+        file_offset,
+        strict,
+        num_threads,
+    )
+
+def split_into_chunks(items, num_chunks):
+    """
+    Splits items into at most num_chunks contiguous, near-equal chunks.
+
+    Returns:
+        list: (chunk, offset) tuples, where offset is the index of chunk[0] in items.
+    """
+    num_chunks = max(1, min(num_chunks, len(items)))
+    chunk_size, remainder = divmod(len(items), num_chunks)
+    chunks = []
+    start = 0
+    for i in range(num_chunks):
+        end = start + chunk_size + (1 if i < remainder else 0)
+        chunks.append((items[start:end], start))
+        start = end
+    return chunks
+
+def convert_parquet_to_webdataset_with_dims(
+    parquet_files,
+    output_dir,
+    output_prefix,
+    samples_per_shard=10000,
+    num_workers=1,
+    target_shard_bytes=TARGET_SHARD_BYTES,
+    strict=False,
+    threads_per_worker=VALIDATE_THREADS,
+    compress=False,
+):
     """
     Converts Parquet files to WebDataset TAR shards.
     Includes 'prompt', 'width', and 'height' in the JSON metadata.
     Keeps only the longest caption as the 'prompt'.
 
+    Runs in two streaming passes so image bytes are never accumulated in memory:
+    the first pass reads captions only, the second reads images and writes them straight to the shards.
+    With num_workers > 1 the Parquet files are split into contiguous ranges, one per worker process,
+    and worker i numbers its shards from i * SHARD_INDEX_STRIDE so shard names never collide.
+
     Args:
         parquet_files (list): List of paths to input Parquet files.
         output_dir (str): Directory to save the output TAR shards.
         output_prefix (str): Prefix for the output shard names (e.g., 'coco-train').
         samples_per_shard (int): Maximum number of samples per TAR shard.
+        num_workers (int): Number of worker processes.
+        target_shard_bytes (int): Maximum size of a TAR shard in bytes; whichever limit is hit first starts a new shard.
+        strict (bool): Run PIL's full verify() on every image instead of trusting parseable headers.
+        threads_per_worker (int): Number of threads in each worker process for images that must be decoded.
+        compress (bool): Write gzip-compressed '.tar.gz' shards instead of plain '.tar'.
     """
     os.makedirs(output_dir, exist_ok=True)
-    shard_pattern = os.path.join(output_dir, f"{output_prefix}-%06d.tar")
-    total_images_processed = 0
-
-    with wds.ShardWriter(shard_pattern, maxcount=samples_per_shard) as sink:
-        # Store the longest prompt text found so far for each image
-        image_data = defaultdict(lambda: {"prompt_text": "", "image_bytes": None})
-
-        print("Step 1: Reading Parquet files and finding longest prompts...")
-        # --- TESTING: Limit files and rows ---
-        # parquet_files = parquet_files[:1] # Process only the first parquet file
-        # print(f"--- TESTING: Limiting to first parquet file: {parquet_files[0]} ---")
-        # --- End Testing ---
-
-        for pf_path in tqdm(parquet_files, desc="Reading Parquets"):
-            try:
-                table = pq.read_table(pf_path)
-                df = table.to_pandas()
-
-                # --- TESTING: Limit rows ---
-                # print(f"--- TESTING: Limiting to first 10 rows of {os.path.basename(pf_path)} ---")
-                # df = df.head(10)
-                 # --- End Testing ---
-
-                for index, row in df.iterrows():
-                    filename = row['filename']
-                    caption = row['caption']
-                    image_field = row['image'] # Could be bytes directly or dict {'bytes': ...}
-
-                    # Extract image bytes carefully
-                    if isinstance(image_field, dict) and 'bytes' in image_field:
-                        image_bytes = image_field['bytes']
-                    elif isinstance(image_field, bytes):
-                        image_bytes = image_field
-                    else:
-                        print(f"Warning: Image data for {filename} is not bytes or expected dict. Type: {type(image_field)}. Skipping.")
-                        continue
-
-                    # Store image bytes once, update prompt if current one is longer
-                    if image_data[filename]["image_bytes"] is None:
-                        image_data[filename]["image_bytes"] = image_bytes
-                        image_data[filename]["prompt_text"] = caption
-                    elif len(caption) > len(image_data[filename]["prompt_text"]):
-                        image_data[filename]["prompt_text"] = caption
+    shard_pattern = os.path.join(output_dir, f"{output_prefix}-%06d.tar.gz" if compress else f"{output_prefix}-%06d.tar")
 
-            except Exception as e:
-                print(f"Error reading or processing Parquet file {pf_path}: {e}")
-                continue
-
-        print(f"\nStep 2: Writing {len(image_data)} unique images to WebDataset shards...")
-        for base_filename, data in tqdm(image_data.items(), desc="Writing Shards"):
-            image_bytes = data["image_bytes"]
-            prompt_text = data["prompt_text"] # Longest prompt text found
+    # --- TESTING: Limit files and rows ---
+    # parquet_files = parquet_files[:1] # Process only the first parquet file
+    # print(f"--- TESTING: Limiting to first parquet file: {parquet_files[0]} ---")
+    # --- End Testing ---
 
-            if image_bytes is None or not prompt_text:
-                print(f"Warning: Missing image bytes or prompt for {base_filename}. Skipping.")
-                continue
+    chunks = split_into_chunks(parquet_files, num_workers)
 
-            # Validate image, get format and dimensions
-            validated_bytes, img_format, width, height = get_image_bytes_validate_and_dims(image_bytes, base_filename)
+    if len(chunks) == 1:
+        print("Step 1: Reading Parquet captions and finding longest prompts...")
+        longest_captions = find_longest_captions(parquet_files)
 
-            if validated_bytes is None:
-                continue # Skip if image is invalid
-
-            # Create the final sample dictionary for WebDataset
-            sample = {
-                "__key__": os.path.splitext(base_filename)[0], # Base filename as key
-                img_format: validated_bytes,                   # Image bytes with format extension as key
-                "json": {                                      # JSON metadata
-                    "prompt": prompt_text,                     # The selected prompt text
-                    "width": width,                            # Image width
-                    "height": height                           # Image height
-                    # Optional: add cocoid back if needed: "cocoid": data.get("cocoid", None)
-                }
-            }
+        print(f"\nStep 2: Writing {len(longest_captions)} unique images to WebDataset shards...")
+        total_images_processed = write_webdataset_shards(
+            parquet_files, shard_pattern, longest_captions, samples_per_shard, target_shard_bytes, strict=strict, num_threads=threads_per_worker
+        )
+    else:
+        print(f"Step 1: Reading Parquet captions and finding longest prompts with {len(chunks)} workers...")
+        with multiprocessing.Pool(len(chunks)) as pool:
+            longest_captions = merge_longest_captions(pool.map(_find_longest_captions_task, chunks))
 
-            # Write the sample
-            sink.write(sample)
-            total_images_processed += 1
+        print(f"\nStep 2: Writing {len(longest_captions)} unique images to WebDataset shards with {len(chunks)} workers...")
+        tasks = [
+            (chunk, shard_pattern, samples_per_shard, target_shard_bytes, worker_idx * SHARD_INDEX_STRIDE, file_offset, strict, threads_per_worker)
+            for worker_idx, (chunk, file_offset) in enumerate(chunks)
+        ]
+        with multiprocessing.Pool(len(chunks), initializer=_init_write_worker, initargs=(longest_captions,)) as pool:
+            total_images_processed = sum(pool.map(_write_webdataset_shards_task, tasks))
 
     print(f"\nFinished conversion.")
     print(f"Processed {total_images_processed} unique images.")
@@ -159,12 +828,34 @@ if __name__ == "__main__":
     parser.add_argument("--input_dir", required=True, help="Directory containing the Parquet files (e.g., 'coco_captions/data').")
     parser.add_argument("--output_dir", required=True, help="Directory where the output WebDataset TAR shards will be saved.")
     parser.add_argument("--split", required=True, choices=['train', 'test'], help="Which split to process ('train' or 'test').")
-    parser.add_argument("--samples_per_shard", type=int, default=10000, help="Number of image samples per TAR shard.")
+    parser.add_argument("--samples_per_shard", type=int, default=10000, help="Maximum number of image samples per TAR shard.")
+    parser.add_argument("--target_shard_bytes", type=int, default=TARGET_SHARD_BYTES, help="Maximum size of a TAR shard in bytes.")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes. With more than 1, worker i numbers its shards from i * %d, so shard names are not contiguous." % SHARD_INDEX_STRIDE,
+    )
+    parser.add_argument("--threads_per_worker", type=int, default=VALIDATE_THREADS, help="Number of threads in each worker process for images that must be decoded.")
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Write gzip-compressed .tar.gz shards (for sequential WebDataset streaming; wids random access needs plain .tar).",
+    )
+    parser.add_argument("--strict", action="store_true", help="Verify every image with PIL (slower); by default well-formed headers are trusted.")
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
 
     parquet_pattern = os.path.join(args.input_dir, f"{args.split}-*.parquet")
-    parquet_files = sorted(glob.glob(parquet_pattern)) # Sort for consistent processing order
+    # One scandir pass over the directory instead of glob's per-entry matching; sort for consistent processing order
+    parquet_files = []
+    if os.path.isdir(args.input_dir):
+        with os.scandir(args.input_dir) as entries:
+            parquet_files = sorted(
+                entry.path for entry in entries
+                if entry.name.startswith(f"{args.split}-") and entry.name.endswith(".parquet")
+            )
 
     if not parquet_files:
         print(f"Error: No Parquet files found matching pattern '{parquet_pattern}'")
@@ -173,4 +864,14 @@ if __name__ == "__main__":
         output_shard_dir = os.path.join(args.output_dir, args.split)
         output_prefix = f"coco-{args.split}"
         # Call the updated function
-        convert_parquet_to_webdataset_with_dims(parquet_files, output_shard_dir, output_prefix, args.samples_per_shard)
\ No newline at end of file
+        convert_parquet_to_webdataset_with_dims(
+            parquet_files,
+            output_shard_dir,
+            output_prefix,
+            args.samples_per_shard,
+            args.num_workers,
+            args.target_shard_bytes,
+            args.strict,
+            args.threads_per_worker,
+            args.compress,
+        )
\ No newline at end of file
@@ -1,24 +1,35 @@
 import numpy as np
 
-# Load the .npy file
+# Load the .npy file memory-mapped: shape/dtype come from the header, data is only paged in when touched
 file_path = 'data/toy_data/00000000/0_1.npy'
-data = np.load(file_path)
+data = np.load(file_path, mmap_mode='r')
+
+# Min/max in blocks so huge files are streamed instead of read into RAM at once
+REDUCE_BLOCK_ELEMENTS = 1 << 24
+flat = data.reshape(-1, order='A') # A view for both C- and Fortran-ordered files
+min_value, max_value = None, None
+for start in range(0, flat.size, REDUCE_BLOCK_ELEMENTS):
+    block = np.asarray(flat[start:start + REDUCE_BLOCK_ELEMENTS]) # ndarray view, so reductions return plain scalars
+    block_min, block_max = block.min(), block.max()
+    # np.minimum/np.maximum propagate NaN like a whole-array min/max; Python's min/max would drop it
+    min_value = block_min if min_value is None else np.minimum(min_value, block_min)
+    max_value = block_max if max_value is None else np.maximum(max_value, block_max)
 
 # Print basic information
 print(f"Data shape: {data.shape}")
 print(f"Data type: {data.dtype}")
-print(f"Min value: {data.min()}")
-print(f"Max value: {data.max()}")
+print(f"Min value: {min_value}")
+print(f"Max value: {max_value}")
 
 # If it's not too large, print a small sample
 if data.size < 50:
-    print(f"Full data: {data}")
+    print(f"Full data: {np.asarray(data)}")
 else:
     if len(data.shape) == 1:
-        print(f"First 10 elements: {data[:10]}")
+        print(f"First 10 elements: {np.asarray(data[:10])}")
     elif len(data.shape) == 2:
-        print(f"Top-left corner (5x5):\n{data[:5, :5]}")
+        print(f"Top-left corner (5x5):\n{np.asarray(data[:5, :5])}")
     elif len(data.shape) == 3:
-        print(f"Sample slice (first channel, 5x5):\n{data[0, :5, :5]}")
+        print(f"Sample slice (first channel, 5x5):\n{np.asarray(data[0, :5, :5])}")
     elif len(data.shape) == 4:
-        print(f"Sample slice (first item, first channel, 5x5):\n{data[0, 0, :5, :5]}") 
\ No newline at end of file
+        print(f"Sample slice (first item, first channel, 5x5):\n{np.asarray(data[0, 0, :5, :5])}")